@@ -5,6 +5,9 @@ const axios = require('axios');
 
 const router = express.Router();
 
+// Time budget for the Python DTW recommender; it returns its best-so-far result once spent
+const DTW_TIME_BUDGET_MS = parseInt(process.env.DTW_TIME_BUDGET_MS || '2000', 10);
+
 // Apply JWT authentication to all routes
 router.use(authenticateToken);
 
@@ -301,7 +304,8 @@ router.post('/pre-process', async (req, res) => {
                                 // Call Python backend for DTW recommendation
                                 const dtwResponse = await axios.post('http://localhost:8000/recommend-mixing', {
                                     current_pattern: hrValues,
-                                    past_events: parsedEvents
+                                    past_events: parsedEvents,
+                                    time_budget_ms: DTW_TIME_BUDGET_MS
                                 });
 
                                 recommendedMixing = dtwResponse.data.recommended_mixing;
@@ -309,7 +313,8 @@ router.post('/pre-process', async (req, res) => {
 
                                 console.log('[PRE-PROCESS] DTW recommendation:', {
                                     mixing: recommendedMixing,
-                                    confidence: confidence.toFixed(2)
+                                    confidence: confidence.toFixed(2),
+                                    evaluated: `${dtwResponse.data.events_evaluated}/${dtwResponse.data.events_total}`
                                 });
 
                             } catch (dtwError) {
@@ -620,7 +625,8 @@ router.post('/recommend', async (req, res) => {
         try {
             const pythonResponse = await axios.post('http://localhost:8000/recommend-mixing', {
                 current_pattern: current_pattern,
-                past_events: formattedEvents
+                past_events: formattedEvents,
+                time_budget_ms: DTW_TIME_BUDGET_MS
             });
 
             console.log('[RECOMMEND] Python recommendation:', pythonResponse.data);
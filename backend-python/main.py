@@ -1,8 +1,21 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse
 from typing import Any, Dict
 import os
 import io
+import re
+import math
+import json
+import time
+import uuid
 import base64
+import contextvars
+import random
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 import soundfile as sf
@@ -12,10 +25,143 @@ from pedalboard.io import AudioFile
 app = FastAPI()
 AUDIO_DIR = "audio_files"
 
+TRACE_RENDER_ALLOCATIONS = os.getenv("TRACE_RENDER_ALLOCATIONS") == "1"
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+
+# --- Library timing ---
+# cProfile charges Pedalboard (pybind11) calls and numpy ufuncs to the Python
+# caller, so profiled requests time each library at its call sites instead.
+# The dict is only set while a request is being profiled.
+_library_timings = contextvars.ContextVar("library_timings", default=None)
+
+@contextmanager
+def _timed(library):
+    timings = _library_timings.get()
+    if timings is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[library] = timings.get(library, 0.0) + time.perf_counter() - started
+
+# --- Render helpers ---
+# Every helper keeps audio in float32 and works on the caller's buffer where
+# possible, so a render holds roughly one copy of the track at a time.
+
+LFO_BLOCK_SAMPLES = 65536
+
+def _lfo(num_samples, rate_hz, sample_rate):
+    """
+    Returns sin(2*pi*rate_hz*t) as a float32 array, computed in place.
+    """
+    step = 2 * np.pi * rate_hz / sample_rate
+    ramp = np.arange(min(num_samples, LFO_BLOCK_SAMPLES), dtype=np.float32)
+    ramp *= np.float32(step)
+
+    # A float32 phase over the whole track loses precision on long files, so the
+    # phase is built per block from a float64 offset wrapped to [0, 2*pi).
+    lfo = np.empty(num_samples, dtype=np.float32)
+    for start in range(0, num_samples, LFO_BLOCK_SAMPLES):
+        block = lfo[start:start + LFO_BLOCK_SAMPLES]
+        offset = (start * step) % (2 * np.pi)
+        np.add(ramp[:len(block)], np.float32(offset), out=block)
+
+    np.sin(lfo, out=lfo)
+    return lfo
+
+@_timed("numpy")
+def _apply_tremolo(audio, sample_rate, rate_hz=6.0, depth=0.3):
+    lfo = _lfo(len(audio), rate_hz, sample_rate)
+    lfo *= np.float32(depth)
+    lfo += np.float32(1 - depth)
+
+    # Handle 2D (stereo) or 1D (mono) audio
+    if audio.ndim == 2:
+        audio *= lfo[:, np.newaxis]
+    else:
+        audio *= lfo
+    return audio
+
+@_timed("numpy")
+def _apply_auto_pan(audio, sample_rate, rate_hz=0.5):
+    pan_angle = _lfo(len(audio), rate_hz, sample_rate)
+    pan_angle += np.float32(1)
+    pan_angle *= np.float32(np.pi / 4)
+
+    if audio.ndim == 1:
+        # Mono -> Stereo: write the gains straight into the output channels
+        stereo = np.empty((len(audio), 2), dtype=np.float32)
+        np.cos(pan_angle, out=stereo[:, 0])
+        stereo[:, 0] *= audio
+        np.sin(pan_angle, out=stereo[:, 1])
+        stereo[:, 1] *= audio
+        return stereo
+
+    # Stereo -> Modulate existing channels
+    left_gain = np.cos(pan_angle)
+    audio[:, 0] *= left_gain
+    np.sin(pan_angle, out=pan_angle)
+    audio[:, 1] *= pan_angle
+    return audio
+
+def _apply_shimmer(audio, sample_rate):
+    shimmer_board = Pedalboard([
+        PitchShift(semitones=12),
+        Reverb(room_size=0.9, damping=0.5, wet_level=0.8, dry_level=0.2),
+        Gain(gain_db=-6)
+    ])
+    # Pedalboard handles stereo input naturally
+    with _timed("pedalboard"):
+        shimmer_audio = shimmer_board(audio, sample_rate)
+    with _timed("numpy"):
+        audio *= np.float32(0.8)
+        shimmer_audio *= np.float32(0.5)
+        audio += shimmer_audio
+    return audio
+
+@_timed("numpy")
+def _normalize_peak(audio):
+    """
+    Scales audio in place so its peak magnitude is at most 1.0.
+    """
+    # Two reductions instead of np.abs(), which would copy the whole track
+    peak = max(float(audio.max()), -float(audio.min()))
+    if peak > 1.0:
+        audio *= np.float32(1.0 / peak)
+    return audio
+
+@contextmanager
+def _track_allocations(report, stage):
+    """
+    Records net and peak traced allocations for one render stage into report.
+    No-op unless tracemalloc is tracing.
+    """
+    if not tracemalloc.is_tracing():
+        yield
+        return
+
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    yield
+    current, peak = tracemalloc.get_traced_memory()
+    report.append({
+        "stage": stage,
+        "net_bytes": current - before,
+        "peak_bytes": peak - before
+    })
+
 @app.post("/process-sleep-data")
 async def process_sleep_data(data: Dict[str, Any]):
     """
     Applies a specific audio effect based on the day of the week.
+    Set TRACE_RENDER_ALLOCATIONS=1 to return a tracemalloc report per pattern.
     """
     print("--- Received data for Day-based Mixing ---")
     
@@ -30,18 +176,28 @@ async def process_sleep_data(data: Dict[str, Any]):
     if not os.path.exists(audio_filepath):
         raise HTTPException(status_code=500, detail=f"Audio file not found: {audio_filepath}")
 
+    started_tracing = TRACE_RENDER_ALLOCATIONS and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    allocation_report = []
+
     try:
-        # Use Pedalboard's AudioFile to read (supports MP3, WAV, etc.)
-        with AudioFile(audio_filepath) as f:
-            audio = f.read(f.frames)
-            sample_rate = f.samplerate
-
-        # Pedalboard returns (channels, samples)
-        if audio.ndim > 1:
-            audio = np.mean(audio, axis=0) # Convert to mono (axis 0 is channels)
-            
-        if audio.dtype != np.float32:
-            audio = audio.astype(np.float32)
+        with _track_allocations(allocation_report, "decode"):
+            # Use Pedalboard's AudioFile to read (supports MP3, WAV, etc.)
+            with _timed("pedalboard"), AudioFile(audio_filepath) as f:
+                audio = f.read(f.frames)
+                sample_rate = f.samplerate
+
+            with _timed("numpy"):
+                # Pedalboard returns (channels, samples)
+                if audio.ndim > 1:
+                    if audio.shape[0] == 1:
+                        audio = audio[0] # Already mono, take a view
+                    else:
+                        audio = np.mean(audio, axis=0, dtype=np.float32) # Convert to mono (axis 0 is channels)
+
+                if audio.dtype != np.float32:
+                    audio = audio.astype(np.float32)
 
         effect_name = ""
         processed_audio = audio
@@ -58,122 +214,65 @@ async def process_sleep_data(data: Dict[str, Any]):
                 pat = pat.strip()
                 if not pat: continue
 
-                if pat == "A": # Tremolo
-                    print(f"  - Applying Tremolo (A)")
-                    tremolo_rate_hz = 6.0
-                    tremolo_depth = 0.3
-                    
-                    # Recalculate LFO based on current audio length
-                    current_len = len(processed_audio)
-                    lfo_time = np.arange(current_len) / sample_rate
-                    
-                    # Handle 2D (stereo) or 1D (mono) audio
-                    if processed_audio.ndim == 2:
-                         lfo = (1 - tremolo_depth) + tremolo_depth * np.sin(2 * np.pi * tremolo_rate_hz * lfo_time)
-                         # Apply to both columns
-                         processed_audio[:, 0] *= lfo
-                         processed_audio[:, 1] *= lfo
-                    else:
-                        lfo = (1 - tremolo_depth) + tremolo_depth * np.sin(2 * np.pi * tremolo_rate_hz * lfo_time)
-                        processed_audio = processed_audio * lfo
-                    
-                    effect_name += "+Tremolo" if effect_name else "Tremolo"
-                    
-                elif pat == "B": # Auto-Pan
-                    print(f"  - Applying Auto-Pan (B)")
-                    pan_rate_hz = 0.5
-                    current_len = len(processed_audio)
-                    
-                    pan_lfo = np.sin(2 * np.pi * pan_rate_hz * (np.arange(current_len) / sample_rate))
-                    pan_angle = (pan_lfo + 1) * (np.pi / 4)
-                    left_gain = np.cos(pan_angle)
-                    right_gain = np.sin(pan_angle)
-                    
-                    if processed_audio.ndim == 1:
-                        # Mono -> Stereo
-                        left_channel = processed_audio * left_gain
-                        right_channel = processed_audio * right_gain
-                        processed_audio = np.empty((current_len, 2), dtype=np.float32)
-                        processed_audio[:, 0] = left_channel
-                        processed_audio[:, 1] = right_channel
-                    else:
-                        # Stereo -> Modulate existing channels
-                        processed_audio[:, 0] *= left_gain
-                        processed_audio[:, 1] *= right_gain
-                    
-                    effect_name += "+Auto-Pan" if effect_name else "Auto-Pan"
-                    
-                elif pat == "C": # Shimmer Reverb
-                    print(f"  - Applying Shimmer Reverb (C)")
-                    shimmer_board = Pedalboard([
-                        PitchShift(semitones=12),
-                        Reverb(room_size=0.9, damping=0.5, wet_level=0.8, dry_level=0.2),
-                        Gain(gain_db=-6)
-                    ])
-                    # Pedalboard handles stereo input naturally
-                    shimmer_audio = shimmer_board(processed_audio, sample_rate)
-                    processed_audio = (processed_audio * 0.8) + (shimmer_audio * 0.5)
-                    effect_name += "+Shimmer" if effect_name else "Shimmer"
-    
-                elif pat == "D": # Delay
-                    print(f"  - Applying Delay (D)")
-                    # Use params from request or default
-                    d_seconds = float(data.get("delay_seconds", 0.5))
-                    d_feedback = float(data.get("delay_feedback", 0.4))
-                    d_mix = float(data.get("delay_mix", 0.5))
-                    
-                    delay_board = Pedalboard([
-                        Delay(delay_seconds=d_seconds, feedback=d_feedback, mix=d_mix),
-                        Gain(gain_db=0)
-                    ])
-                    processed_audio = delay_board(processed_audio, sample_rate)
-                    effect_name += "+Delay" if effect_name else "Delay"
-
-                elif pat == "E": # Chorus
-                    print(f"  - Applying Chorus (E)")
-                    # Use params from request or default
-                    c_rate = float(data.get("chorus_rate", 2.1))
-                    c_depth = float(data.get("chorus_depth", 0.45))
-                    c_mix = float(data.get("chorus_mix", 0.3))
-                    
-                    chorus_board = Pedalboard([
-                        Chorus(rate_hz=c_rate, depth=c_depth, centre_delay_ms=7.0, feedback=0.0, mix=c_mix),
-                        Gain(gain_db=0)
-                    ])
-                    processed_audio = chorus_board(processed_audio, sample_rate)
-                    effect_name += "+Chorus" if effect_name else "Chorus"
+                with _track_allocations(allocation_report, pat):
+                    if pat == "A": # Tremolo
+                        print(f"  - Applying Tremolo (A)")
+                        processed_audio = _apply_tremolo(processed_audio, sample_rate)
+                        effect_name += "+Tremolo" if effect_name else "Tremolo"
+
+                    elif pat == "B": # Auto-Pan
+                        print(f"  - Applying Auto-Pan (B)")
+                        processed_audio = _apply_auto_pan(processed_audio, sample_rate)
+                        effect_name += "+Auto-Pan" if effect_name else "Auto-Pan"
+
+                    elif pat == "C": # Shimmer Reverb
+                        print(f"  - Applying Shimmer Reverb (C)")
+                        processed_audio = _apply_shimmer(processed_audio, sample_rate)
+                        effect_name += "+Shimmer" if effect_name else "Shimmer"
+
+                    elif pat == "D": # Delay
+                        print(f"  - Applying Delay (D)")
+                        # Use params from request or default
+                        d_seconds = float(data.get("delay_seconds", 0.5))
+                        d_feedback = float(data.get("delay_feedback", 0.4))
+                        d_mix = float(data.get("delay_mix", 0.5))
+
+                        delay_board = Pedalboard([
+                            Delay(delay_seconds=d_seconds, feedback=d_feedback, mix=d_mix),
+                            Gain(gain_db=0)
+                        ])
+                        with _timed("pedalboard"):
+                            processed_audio = delay_board(processed_audio, sample_rate)
+                        effect_name += "+Delay" if effect_name else "Delay"
+
+                    elif pat == "E": # Chorus
+                        print(f"  - Applying Chorus (E)")
+                        # Use params from request or default
+                        c_rate = float(data.get("chorus_rate", 2.1))
+                        c_depth = float(data.get("chorus_depth", 0.45))
+                        c_mix = float(data.get("chorus_mix", 0.3))
+
+                        chorus_board = Pedalboard([
+                            Chorus(rate_hz=c_rate, depth=c_depth, centre_delay_ms=7.0, feedback=0.0, mix=c_mix),
+                            Gain(gain_db=0)
+                        ])
+                        with _timed("pedalboard"):
+                            processed_audio = chorus_board(processed_audio, sample_rate)
+                        effect_name += "+Chorus" if effect_name else "Chorus"
         elif day_of_week is not None:
             day = int(day_of_week)
-            if day in [1, 3, 6]: # Mon, Wed, Sat -> Tremolo
-                effect_name = "Tremolo"
-                tremolo_rate_hz = 6.0
-                tremolo_depth = 0.3
-                lfo_time = np.arange(len(audio)) / sample_rate
-                lfo = (1 - tremolo_depth) + tremolo_depth * np.sin(2 * np.pi * tremolo_rate_hz * lfo_time)
-                processed_audio = audio * lfo
-
-            elif day in [2, 5]: # Tue, Fri -> Auto-Pan
-                effect_name = "Auto-Pan"
-                pan_rate_hz = 0.5
-                pan_lfo = np.sin(2 * np.pi * pan_rate_hz * (np.arange(len(audio)) / sample_rate))
-                pan_angle = (pan_lfo + 1) * (np.pi / 4)
-                left_gain = np.cos(pan_angle)
-                right_gain = np.sin(pan_angle)
-                left_channel = audio * left_gain
-                right_channel = audio * right_gain
-                processed_audio = np.empty((len(audio), 2), dtype=np.float32)
-                processed_audio[:, 0] = left_channel
-                processed_audio[:, 1] = right_channel
-
-            elif day in [0, 4]: # Sun, Thu -> Shimmer Reverb
-                effect_name = "Shimmer Reverb"
-                shimmer_board = Pedalboard([
-                    PitchShift(semitones=12),
-                    Reverb(room_size=0.9, damping=0.5, wet_level=0.8, dry_level=0.2),
-                    Gain(gain_db=-6)
-                ])
-                shimmer_audio = shimmer_board(audio, sample_rate)
-                processed_audio = (audio * 0.8) + (shimmer_audio * 0.5)
+            with _track_allocations(allocation_report, f"day-{day}"):
+                if day in [1, 3, 6]: # Mon, Wed, Sat -> Tremolo
+                    effect_name = "Tremolo"
+                    processed_audio = _apply_tremolo(audio, sample_rate)
+
+                elif day in [2, 5]: # Tue, Fri -> Auto-Pan
+                    effect_name = "Auto-Pan"
+                    processed_audio = _apply_auto_pan(audio, sample_rate)
+
+                elif day in [0, 4]: # Sun, Thu -> Shimmer Reverb
+                    effect_name = "Shimmer Reverb"
+                    processed_audio = _apply_shimmer(audio, sample_rate)
         
         else:
              # Default if neither provided
@@ -181,29 +280,38 @@ async def process_sleep_data(data: Dict[str, Any]):
 
         print(f"Applied effect: {effect_name}")
 
-        # Normalize
-        max_val = np.max(np.abs(processed_audio))
-        if max_val > 1.0:
-            processed_audio = processed_audio / max_val
+        with _track_allocations(allocation_report, "normalize"):
+            processed_audio = _normalize_peak(processed_audio)
 
         # --- Export and Encode ---
-        buffer = io.BytesIO()
-        sf.write(buffer, processed_audio, sample_rate, format='WAV')
-        buffer.seek(0)
-        audio_base64 = base64.b64encode(buffer.read()).decode('utf-8')
+        with _track_allocations(allocation_report, "encode"), _timed("encoding"):
+            buffer = io.BytesIO()
+            sf.write(buffer, processed_audio, sample_rate, format='WAV')
+            audio_base64 = base64.b64encode(buffer.getbuffer()).decode('utf-8')
 
-        return {
+        response = {
             "message": f"{effect_name} effect applied successfully.",
             "effect_applied": effect_name,
             "audio_format": "wav",
             "audio_data_base64": audio_base64
         }
 
+        if allocation_report:
+            for entry in allocation_report:
+                print(f"[RENDER-ALLOC] {entry['stage']}: net={entry['net_bytes'] / 1e6:.2f}MB, peak={entry['peak_bytes'] / 1e6:.2f}MB")
+            response["allocation_report"] = allocation_report
+
+        return response
+
     except Exception as e:
         print(f"--- ERROR in /process-sleep-data ---")
         print(e)
         raise HTTPException(status_code=500, detail=f"Error processing audio: {str(e)}")
 
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+
 @app.post("/analyze-sleep-cycle")
 async def analyze_sleep_cycle(payload: Dict[str, Any]):
     """
@@ -233,7 +341,8 @@ async def analyze_sleep_cycle(payload: Dict[str, Any]):
 
             for stage in sleep_stages:
                 if stage['level'] == 'rem':
-                    start_time_dt = pd.to_datetime(stage['dateTime'])
+                    with _timed("pandas"):
+                        start_time_dt = pd.to_datetime(stage['dateTime'])
                     rem_sleep_timestamps.append(start_time_dt)
             
             if len(rem_sleep_timestamps) > 1:
@@ -283,22 +392,23 @@ async def resample_and_analyze(data: Dict[str, Any]):
         if not date_str or not intraday_data:
             raise HTTPException(status_code=400, detail="Invalid hr_dataset format.")
 
-        # Create a pandas DataFrame
-        df = pd.DataFrame(intraday_data)
-        
-        # Combine date and time to create a proper datetime index
-        df['time'] = pd.to_datetime(date_str + ' ' + df['time'])
-        df = df.set_index('time')
-
-        # Resample to 1-second intervals and forward-fill missing values
-        df_resampled = df.resample('1S').ffill()
-
-        # Convert the resampled data back to a JSON-friendly format
-        df_resampled = df_resampled.reset_index()
-        resampled_data = {
-            "time": df_resampled['time'].dt.strftime('%H:%M:%S').tolist(),
-            "value": df_resampled['value'].tolist()
-        }
+        with _timed("pandas"):
+            # Create a pandas DataFrame
+            df = pd.DataFrame(intraday_data)
+
+            # Combine date and time to create a proper datetime index
+            df['time'] = pd.to_datetime(date_str + ' ' + df['time'])
+            df = df.set_index('time')
+
+            # Resample to 1-second intervals and forward-fill missing values
+            df_resampled = df.resample('1S').ffill()
+
+            # Convert the resampled data back to a JSON-friendly format
+            df_resampled = df_resampled.reset_index()
+            resampled_data = {
+                "time": df_resampled['time'].dt.strftime('%H:%M:%S').tolist(),
+                "value": df_resampled['value'].tolist()
+            }
 
         return {
             "message": "Heart rate data resampled successfully.",
@@ -328,12 +438,13 @@ async def analyze_awakening(data: Dict[str, Any]):
         if not date_str or not intraday_data:
             raise HTTPException(status_code=400, detail="Invalid hr_dataset format for resampling.")
 
-        df = pd.DataFrame(intraday_data)
-        df['time'] = pd.to_datetime(date_str + ' ' + df['time'], format='%Y-%m-%d %H:%M:%S')
-        df = df.set_index('time')
-        df_resampled = df.resample('1s').ffill().bfill()
-        
-        hr_values = df_resampled['value'].to_numpy()
+        with _timed("pandas"):
+            df = pd.DataFrame(intraday_data)
+            df['time'] = pd.to_datetime(date_str + ' ' + df['time'], format='%Y-%m-%d %H:%M:%S')
+            df = df.set_index('time')
+            df_resampled = df.resample('1s').ffill().bfill()
+
+            hr_values = df_resampled['value'].to_numpy()
 
         if len(hr_values) < 120:
              raise HTTPException(status_code=400, detail=f"Insufficient data for analysis. At least 120 points needed, got {len(hr_values)}.")
@@ -406,15 +517,29 @@ async def calculate_awakening_metrics(data: Dict[str, Any]):
         print(e)
         raise HTTPException(status_code=500, detail=f"Error calculating metrics: {str(e)}")
 
+def _dtw_lower_bound(s1, s2):
+    """
+    Cheap lower bound on dtw.distance (LB_Kim): every warping path pairs the
+    first points together and the last points together.
+    """
+    first = s1[0] - s2[0]
+    if len(s1) == 1 and len(s2) == 1:
+        return abs(float(first))
+    last = s1[-1] - s2[-1]
+    return float(np.sqrt(first * first + last * last))
+
 @app.post("/calculate-dtw-similarity")
 async def calculate_dtw_similarity(data: Dict[str, Any]):
     """
     Calculates DTW similarity between current HR pattern and past events.
     Expects: { 
         "current_pattern": [60, 61, ...],
-        "past_events": [{"event_id": 1, "hr_pattern_before": [...], "mixing_pattern": "A", "comfort_score": 75.5}, ...]
+        "past_events": [{"event_id": 1, "hr_pattern_before": [...], "mixing_pattern": "A", "comfort_score": 75.5}, ...],
+        "time_budget_ms": 2000,          # optional, stop scoring once spent
+        "evaluation_order": "recent"     # optional, "recent" (input order) or "lower_bound"
     }
-    Returns: { "similarities": [{event_id, similarity, mixing_pattern, comfort_score}, ...] }
+    Returns: { "similarities": [{event_id, similarity, mixing_pattern, comfort_score}, ...],
+               "events_evaluated": 12, "events_total": 50, "budget_exhausted": true }
     """
     try:
         from dtaidistance import dtw
@@ -426,20 +551,47 @@ async def calculate_dtw_similarity(data: Dict[str, Any]):
     
     if not current_pattern or not isinstance(current_pattern, list):
         raise HTTPException(status_code=400, detail="current_pattern array is required.")
+
+    evaluation_order = data.get("evaluation_order", "recent")
+    if evaluation_order not in ("recent", "lower_bound"):
+        raise HTTPException(status_code=400, detail="evaluation_order must be 'recent' or 'lower_bound'.")
+
+    deadline = None
+    time_budget_ms = data.get("time_budget_ms")
+    if time_budget_ms is not None:
+        # bool is an int subclass, and NaN/inf would give a deadline that never arrives
+        if (isinstance(time_budget_ms, bool) or not isinstance(time_budget_ms, (int, float))
+                or not math.isfinite(time_budget_ms) or time_budget_ms < 0):
+            raise HTTPException(status_code=400, detail="time_budget_ms must be a finite, non-negative number.")
+        deadline = time.perf_counter() + time_budget_ms / 1000
     
     try:
-        current_array = np.array(current_pattern, dtype=float)
         similarities = []
-        
-        for event in past_events:
-            past_pattern = event.get("hr_pattern_before")
-            if not past_pattern:
-                continue
-            
-            past_array = np.array(past_pattern, dtype=float)
+
+        with _timed("numpy"):
+            current_array = np.array(current_pattern, dtype=float)
+
+            candidates = []
+            for event in past_events:
+                past_pattern = event.get("hr_pattern_before")
+                if not past_pattern:
+                    continue
+                candidates.append((event, np.array(past_pattern, dtype=float)))
+
+            # Past events arrive most recent first; optionally score the likeliest matches first instead
+            if evaluation_order == "lower_bound":
+                candidates.sort(key=lambda c: _dtw_lower_bound(current_array, c[1]))
+
+        budget_exhausted = False
+        for event, past_array in candidates:
+            # Always score at least one event so a tight budget still yields a result
+            if deadline is not None and similarities and time.perf_counter() >= deadline:
+                budget_exhausted = True
+                break
             
             # Calculate DTW distance
-            distance = dtw.distance(current_array, past_array)
+            with _timed("dtaidistance"):
+                distance = dtw.distance(current_array, past_array)
             
             # Convert to similarity (0-1, higher is more similar)
             similarity = 1 / (1 + distance)
@@ -454,9 +606,15 @@ async def calculate_dtw_similarity(data: Dict[str, Any]):
         # Sort by similarity (descending)
         similarities.sort(key=lambda x: x["similarity"], reverse=True)
         
-        print(f"[DTW-SIMILARITY] Calculated {len(similarities)} similarities")
+        print(f"[DTW-SIMILARITY] Calculated {len(similarities)}/{len(candidates)} similarities"
+              + (" (time budget exhausted)" if budget_exhausted else ""))
         
-        return {"similarities": similarities}
+        return {
+            "similarities": similarities,
+            "events_evaluated": len(similarities),
+            "events_total": len(candidates),
+            "budget_exhausted": budget_exhausted
+        }
         
     except Exception as e:
         print(f"--- ERROR in /calculate-dtw-similarity ---")
@@ -467,13 +625,19 @@ async def calculate_dtw_similarity(data: Dict[str, Any]):
 async def recommend_mixing(data: Dict[str, Any]):
     """
     Recommends optimal alarm mixing based on DTW similarity.
-    Expects: { "current_pattern": [...], "past_events": [...] }
-    Returns: { "recommended_mixing": "A", "confidence": 0.85, "mixing_scores": {...}, "similar_events_count": 12 }
+    Expects: { "current_pattern": [...], "past_events": [...], "time_budget_ms": 2000, "evaluation_order": "recent" }
+    Returns: { "recommended_mixing": "A", "confidence": 0.85, "mixing_scores": {...}, "similar_events_count": 12,
+               "events_evaluated": 30, "events_total": 50, "coverage": 0.6, "budget_exhausted": true }
+    When the time budget runs out, the rules below run on the events scored so far.
     """
     try:
         # Calculate DTW similarities
         dtw_result = await calculate_dtw_similarity(data)
         similarities = dtw_result["similarities"]
+        events_evaluated = dtw_result["events_evaluated"]
+        events_total = dtw_result["events_total"]
+        budget_exhausted = dtw_result["budget_exhausted"]
+        coverage = events_evaluated / events_total if events_total else 1.0
         
         if not similarities:
             # No past data - return default
@@ -482,6 +646,10 @@ async def recommend_mixing(data: Dict[str, Any]):
                 "confidence": 0.5,
                 "mixing_scores": {},
                 "similar_events_count": 0,
+                "events_evaluated": 0,
+                "events_total": events_total,
+                "coverage": coverage,
+                "budget_exhausted": budget_exhausted,
                 "note": "No past data available, using default mixing A"
             }
         
@@ -622,6 +790,12 @@ async def recommend_mixing(data: Dict[str, Any]):
                 confidence = 0.7
                 note = "Single pattern found."
 
+        if budget_exhausted:
+            # Shrink toward the no-data default (0.5) in proportion to the events left unscored
+            confidence = 0.5 + (confidence - 0.5) * coverage
+            partial_note = f"Partial coverage: {events_evaluated}/{events_total} events scored within {data.get('time_budget_ms')}ms."
+            note = f"{note.rstrip('.')}. {partial_note}" if note else partial_note
+
         print(f"[RECOMMEND-MIXING] Recommended: {recommended}, Confidence: {confidence:.2f}, Note: {note}")
         
         return {
@@ -629,14 +803,188 @@ async def recommend_mixing(data: Dict[str, Any]):
             "confidence": float(confidence),
             "mixing_scores": pattern_counts, # Returning raw counts as scores for now
             "similar_events_count": len(similar_events),
+            "events_evaluated": events_evaluated,
+            "events_total": events_total,
+            "coverage": round(coverage, 3),
+            "budget_exhausted": budget_exhausted,
             "note": note
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"--- ERROR in /recommend-mixing ---")
         print(e)
         raise HTTPException(status_code=500, detail=f"Error recommending mixing: {str(e)}")
 
+# --- Request profiling ---
+# Opt-in: set PROFILING_ENABLED=1, then send "X-Profile: 1" or "?profile=1",
+# or set PROFILE_SAMPLE_RATE (0.0-1.0) to profile a fraction of all requests.
+#
+# cProfile hooks the whole event-loop thread while the request runs, so the
+# .prof file can include other requests handled in the same window. The
+# breakdown_seconds in the summary come from _timed() and only cover this request.
+
+PROFILE_LIBRARIES = ["numpy", "pedalboard", "pandas", "dtaidistance", "json", "encoding"]
+PROFILE_ID_PATTERN = r"\d{8}-\d{6}-[A-Za-z0-9_-]{1,64}"
+
+# cProfile can only hook one request at a time
+_profile_lock = threading.Lock()
+
+def _json_seconds(stats):
+    """
+    Cumulative time in FastAPI's jsonable_encoder and json.dumps, the
+    serialization entry points that run after the handler returns.
+    """
+    seconds = 0.0
+    for (filename, _, funcname), (_, _, _, cumtime, _) in stats.stats.items():
+        in_json_module = os.path.basename(os.path.dirname(filename)) == "json"
+        if funcname == "jsonable_encoder" or (in_json_module and funcname == "dumps"):
+            seconds += cumtime
+    return seconds
+
+def _profile_breakdown(stats, timings, wall_seconds):
+    breakdown = {name: timings.get(name, 0.0) for name in PROFILE_LIBRARIES}
+    breakdown["json"] += _json_seconds(stats)
+    breakdown["other"] = max(0.0, wall_seconds - sum(breakdown.values()))
+    return {name: round(seconds, 6) for name, seconds in breakdown.items()}
+
+def _prune_profiles():
+    profiles = sorted(
+        (f for f in os.listdir(PROFILE_DIR) if f.endswith(".prof")),
+        key=lambda f: os.path.getmtime(os.path.join(PROFILE_DIR, f))
+    )
+    for filename in profiles[:max(0, len(profiles) - PROFILE_MAX_FILES)]:
+        profile_id = filename[:-len(".prof")]
+        for ext in (".prof", ".json"):
+            path = os.path.join(PROFILE_DIR, profile_id + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+def _save_profile(profiler, timings, request_id, request, status_code, wall_seconds, sampled):
+    """
+    Writes <profile_id>.prof (pstats) and <profile_id>.json (summary) to PROFILE_DIR.
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{request_id}"
+
+    stats = pstats.Stats(profiler)
+    stats.dump_stats(os.path.join(PROFILE_DIR, profile_id + ".prof"))
+
+    summary = {
+        "profile_id": profile_id,
+        "request_id": request_id,
+        "method": request.method,
+        "path": request.url.path,
+        "query": str(request.url.query),
+        "status_code": status_code,
+        "sampled": sampled,
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "wall_seconds": round(wall_seconds, 6),
+        "breakdown_seconds": _profile_breakdown(stats, timings, wall_seconds)
+    }
+    with open(os.path.join(PROFILE_DIR, profile_id + ".json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+
+    _prune_profiles()
+    return profile_id
+
+async def profile_requests(request: Request, call_next):
+    """
+    Runs the request under cProfile when asked for or sampled, and saves the result.
+    """
+    if request.url.path.startswith("/profiles"):
+        return await call_next(request)
+
+    requested = request.headers.get("x-profile") == "1" or request.query_params.get("profile") == "1"
+    sampled = not requested and random.random() < PROFILE_SAMPLE_RATE
+    if not (requested or sampled):
+        return await call_next(request)
+
+    if not _profile_lock.acquire(blocking=False):
+        print(f"[PROFILE] Another request is being profiled, skipping {request.url.path}")
+        return await call_next(request)
+
+    try:
+        request_id = request.headers.get("x-request-id", "")
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", request_id):
+            request_id = uuid.uuid4().hex
+
+        profiler = cProfile.Profile()
+        timings = {}
+        # Set before call_next so the endpoint task inherits it
+        timings_token = _library_timings.set(timings)
+        status_code = 500
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+        finally:
+            profiler.disable()
+            _library_timings.reset(timings_token)
+            wall_seconds = time.perf_counter() - started
+            try:
+                profile_id = _save_profile(profiler, timings, request_id, request, status_code, wall_seconds, sampled)
+                print(f"[PROFILE] Saved {profile_id} ({request.url.path}, {wall_seconds:.3f}s)")
+            except Exception as e:
+                profile_id = None
+                print(f"[PROFILE] Failed to save profile for {request.url.path}: {e}")
+
+        if profile_id:
+            response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    finally:
+        _profile_lock.release()
+
+# Only wrap requests in BaseHTTPMiddleware when profiling is switched on
+if PROFILING_ENABLED:
+    app.middleware("http")(profile_requests)
+
+@app.get("/profiles")
+async def list_profiles(limit: int = 20):
+    """
+    Lists the most recent saved profile summaries, newest first.
+    """
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled.")
+    if not os.path.isdir(PROFILE_DIR):
+        return {"profiles": []}
+
+    summaries = sorted(
+        (f for f in os.listdir(PROFILE_DIR) if f.endswith(".json")),
+        key=lambda f: os.path.getmtime(os.path.join(PROFILE_DIR, f)),
+        reverse=True
+    )
+
+    profiles = []
+    for filename in summaries[:max(0, limit)]:
+        with open(os.path.join(PROFILE_DIR, filename), encoding="utf-8") as f:
+            profiles.append(json.load(f))
+
+    return {"profiles": profiles}
+
+@app.get("/profiles/{profile_id}")
+async def download_profile(profile_id: str, format: str = "pstats"):
+    """
+    Downloads a saved profile as pstats (default) or its JSON summary (?format=summary).
+    """
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled.")
+    if format not in ("pstats", "summary"):
+        raise HTTPException(status_code=400, detail="format must be 'pstats' or 'summary'.")
+    if not re.fullmatch(PROFILE_ID_PATTERN, profile_id):
+        raise HTTPException(status_code=400, detail="Invalid profile id.")
+
+    ext = ".prof" if format == "pstats" else ".json"
+    path = os.path.join(PROFILE_DIR, profile_id + ext)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"Profile not found: {profile_id}")
+
+    media_type = "application/octet-stream" if format == "pstats" else "application/json"
+    return FileResponse(path, media_type=media_type, filename=profile_id + ext)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)